@@ -15,8 +15,106 @@ Date: 04/08/2020
 import string
 import argparse
 import os
+import heapq
+from collections import defaultdict
 from time import localtime
-from py_expression_eval import Parser
+import numpy as np
+from py_expression_eval import Parser, TOP1
+
+INF = float('inf')
+
+# no ignored edges, for dijkstra calls that use them all (shared, so as not to allocate per call)
+NO_EDGES = frozenset()
+NO_EDGES_MASK = np.zeros(0, dtype=np.bool_)
+
+# routes whose flow falls below this fraction of their OD demand are dropped by run_MSA
+PRUNE_EPSILON = 1e-9
+
+def npLog(x, base=None):
+    '''
+    Element-wise counterpart of math.log, which py_expression_eval's log calls with an optional
+    base (np.log's second argument is its output array instead).
+    '''
+    if base is None:
+        return np.log(x)
+    return np.log(x) / np.log(base)
+
+# NumPy counterparts of the functions of py_expression_eval that compiled cost functions may use
+NP_FUNCTIONS = {'sqrt': np.sqrt, 'exp': np.exp, 'log': npLog, 'abs': np.abs, 'ceil': np.ceil,
+                'floor': np.floor, 'sin': np.sin, 'cos': np.cos, 'tan': np.tan, 'pow': np.power}
+
+try:
+    from numba import njit
+except ImportError: # Numba is optional, NumPy is used instead
+    njit = None
+
+if njit is not None:
+    # explicit signatures compile the kernels eagerly, at import time, instead of on first call
+    @njit('void(int64[::1], float64, float64[::1])', cache=True)
+    def scatterRouteFlow(route_idx, vna, aux_flow):
+        '''
+        Adds the flow vna of a route to the auxiliary flow of each of its edges.
+        '''
+        for i in range(route_idx.shape[0]):
+            aux_flow[route_idx[i]] += vna
+
+    @njit('void(int64[::1], int64[::1], int64[::1], float64[::1], boolean[::1], int64, int64, '
+          'float64[::1], int64[::1], int64[::1], int64[::1], int64)', cache=True)
+    def dijkstraTree(adj_start, adj_end, adj_edge, adj_cost, ignored, origin, destination,
+                     dist, prev, reached, visited, gen):
+        '''
+        Compiled main loop of dijkstra, over NumPy adjacency and buffers (see dijkstra).
+        An edge e is ignored if ignored is not empty and ignored[e] is set, and a negative
+        destination computes the shortest paths to all nodes.
+        '''
+        dist[origin] = 0.0
+        reached[origin] = gen
+        # ties are settled by node id, i.e., in N order (see dijkstra)
+        heap = [(0.0, origin)]
+        while len(heap) > 0:
+            d, u = heapq.heappop(heap)
+            if visited[u] == gen:
+                continue
+            visited[u] = gen
+            if u == destination:
+                break
+            for k in range(adj_start[u], adj_start[u+1]):
+                e = adj_edge[k]
+                if ignored.shape[0] > 0 and ignored[e]:
+                    continue
+                v = adj_end[k]
+                alt = d + adj_cost[k]
+                if reached[v] != gen or alt < dist[v]:
+                    reached[v] = gen
+                    dist[v] = alt
+                    prev[v] = e
+                    heapq.heappush(heap, (alt, v))
+
+    @njit('int64[::1](int64[::1], int64[::1], int64[::1], int64, int64, int64)', cache=True)
+    def tracePathKernel(edge_start, prev, reached, origin, destination, gen):
+        '''
+        Compiled version of tracePath, over NumPy buffers.
+        '''
+        if reached[destination] != gen:
+            return np.empty(0, dtype=np.int64)
+        n = 0
+        u = destination
+        while u != origin:
+            n += 1
+            u = edge_start[prev[u]]
+        S = np.empty(n, dtype=np.int64)
+        u = destination
+        while u != origin:
+            n -= 1
+            S[n] = prev[u]
+            u = edge_start[prev[u]]
+        return S
+else:
+    def scatterRouteFlow(route_idx, vna, aux_flow):
+        '''
+        Adds the flow vna of a route to the auxiliary flow of each of its edges.
+        '''
+        np.add.at(aux_flow, route_idx, vna)
 
 class Node(object):
     """
@@ -28,9 +126,6 @@ class Node(object):
             name:String = Name of the node.
         """
         self.name = name        # name of the node
-        self.dist = 1000000     # distance to this node from start node
-        self.prev = None        # previous node to this node
-        self.flag = 0           # access flag
 
     def __repr__(self):
         return repr(self.name)
@@ -54,6 +149,10 @@ class Edge(object):
         self.cost = 0
         self.aux_flow = 0
 
+        self.idx = None # Position of the edge in the cost arrays (set by run_MSA)
+        self.start_id = None # Ids of the start and end nodes (set by run_MSA)
+        self.end_id = None
+
         self.update_cost() # Update for the initial cost
 
     def update_cost(self):
@@ -61,12 +160,42 @@ class Edge(object):
         Using the function and params attributes, it updates the cost of the edge.
         '''
         self.params[self.var] = self.flow
-        self.cost = self.function[2].evaluate(self.params)
+        # functions built by callers may lack the compiled version (see generateGraph)
+        compiled = self.function[3] if len(self.function) > 3 else None
+        if compiled is not None:
+            self.cost = compiled(self.flow, *[self.params[c] for c in self.function[1]])
+        else:
+            self.cost = self.function[2].evaluate(self.params)
 
     def __repr__(self):
         return str(str(self.start) + '-' + str(self.end))
 
 
+def compileCostFunction(function, param, constants):
+    '''
+    Compiles a parsed cost function into a Python function of (param, *constants), which also
+    works element-wise on NumPy arrays.
+    In:
+        function:Expression = The function, as parsed by py_expression_eval.
+        param:String = The function's parameter (the flow).
+        constants:List = The function's constants, in the order they are passed.
+    Out:
+        The compiled function, or None if the expression uses operators with no NumPy counterpart.
+    '''
+    called = set(function.symbols()) - set(function.variables())
+    # unary minus translates as is; not binds looser in Python than in py_expression_eval
+    called.update(t.index_ for t in function.tokens if t.type_ == TOP1 and t.index_ != '-')
+    if not called <= NP_FUNCTIONS.keys():
+        return None
+
+    namespace = {'__builtins__': {}}
+    namespace.update(NP_FUNCTIONS)
+    try:
+        source = str(function.toString()).replace('^', '**')
+        return eval('lambda %s: %s' % (', '.join([param] + constants), source), namespace)
+    except (SyntaxError, TypeError):
+        return None
+
 def generateGraph(graph_file, flow=0.0):
     """
     Adapted version from the KSP repository version 1.44.
@@ -87,147 +216,227 @@ def generateGraph(graph_file, flow=0.0):
     F = {} # cost functions
     OD = {} # OD pairs
 
-    lineid = 0
-    for line in open(graph_file, 'r'):
-        lineid += 1
-        # ignore \n
-        line = line.rstrip()
-        # ignore comments
-        hash_pos = line.find('#')
-        if hash_pos > -1:
-            line = line[:hash_pos]
-
-        # split the line
-        taglist = line.split()
-        if len(taglist) == 0:
-            continue
+    def processFunction(taglist):
+        # process the params
+        params = taglist[2][1:-1].split(',')
+        if len(params) > 1:
+            raise Exception('Cost functions with more than one parameter are not yet'\
+                            'acceptable! (parameters defined: %s)' % str(params)[1:-1])
 
-        if taglist[0] == 'function':
-            # process the params
-            params = taglist[2][1:-1].split(',')
-            if len(params) > 1:
-                raise Exception('Cost functions with more than one parameter are not yet'\
-                                'acceptable! (parameters defined: %s)' % str(params)[1:-1])
+        # process the function
+        function = Parser().parse(taglist[3])
 
-            # process the function
-            function = Parser().parse(taglist[3])
+        # process the constants
+        constants = function.variables()
+        if params[0] in constants: # the parameter must be ignored
+            constants.remove(params[0])
 
-            # process the constants
-            constants = function.variables()
-            if params[0] in constants: # the parameter must be ignored
-                constants.remove(params[0])
+        # store the function, along with its compiled version
+        F[taglist[1]] = [params[0], constants, function,
+                         compileCostFunction(function, params[0], constants)]
 
-            # store the function
-            F[taglist[1]] = [params[0], constants, function]
+    def processNode(taglist):
+        V.append(Node(taglist[1]))
 
-        elif taglist[0] == 'node':
-            V.append(Node(taglist[1]))
+    def processEdge(taglist): # dedge is a directed edge
+        # process the cost
+        function = F[taglist[4]] # get the corresponding function
+        # associate constants and values specified in the line (in order of occurrence)
+        param_values = dict(zip(function[1], map(float, taglist[5:])))
 
-        elif taglist[0] == 'dedge' or taglist[0] == 'edge': # dedge is a directed edge
-            # process the cost
-            function = F[taglist[4]] # get the corresponding function
-            # associate constants and values specified in the line (in order of occurrence)
-            param_values = dict(zip(function[1], map(float, taglist[5:])))
+        param_values[function[0]] = flow # set the function's parameter with the flow value
 
-            param_values[function[0]] = flow # set the function's parameter with the flow value
+        # create the edge(s)
+        E.append(Edge(taglist[2], taglist[3], function, param_values, function[0]))
+        if taglist[0] == 'edge':
+            E.append(Edge(taglist[3], taglist[2], function, param_values, function[0]))
 
-            # create the edge(s)
-            E.append(Edge(taglist[2], taglist[3], function, param_values, function[0]))
-            if taglist[0] == 'edge':
-                E.append(Edge(taglist[3], taglist[2], function, param_values, function[0]))
+    def processOD(taglist):
+        if taglist[2] != taglist[3]:
+            OD[taglist[1]] = float(taglist[4])
 
-        elif taglist[0] == 'od':
-            if taglist[2] != taglist[3]:
-                OD[taglist[1]] = float(taglist[4])
+    handlers = {'function': processFunction, 'node': processNode, 'dedge': processEdge,
+                'edge': processEdge, 'od': processOD}
 
-        else:
+    with open(graph_file, 'r') as f:
+        lines = f.read().splitlines()
+
+    for lineid, line in enumerate(lines, 1):
+        # ignore comments and split the line
+        line = line.partition('#')[0]
+        taglist = line.split()
+        if not taglist:
+            continue
+
+        handler = handlers.get(taglist[0])
+        if handler is None:
             raise Exception('Network file does not comply with the specification!'\
-                            '(line %d: "%s")' % (lineid, line))
+                            '(line %d: "%s")' % (lineid, line.rstrip()))
+        handler(taglist)
 
     return V, E, OD
 
-def resetGraph(N):
+def buildCostGroups(E):
     '''
-    Reset graph's variables to default.
+    Groups the edges by cost function, gathering their constants into arrays.
+    In:
+        E:List = List of the edges of the graph, already indexed by run_MSA.
+    Out:
+        groups:List = For each cost function, a list [function, idx, params, vectorized], where
+            idx are the positions of its edges, params maps each constant to the array of
+            its values, and vectorized tells whether the function can be evaluated on arrays.
     '''
-    for node in N:
-        node.dist = 1000000.0
-        node.prev = None
-        node.flag = 0
+    by_function = {}
+    for edge in E:
+        by_function.setdefault(id(edge.function), (edge.function, []))[1].append(edge)
 
-def pickSmallestNode(N):
+    groups = []
+    for function, edges in by_function.values():
+        idx = np.array([edge.idx for edge in edges], dtype=np.int64)
+        params = {c: np.array([edge.params[c] for edge in edges], dtype=np.float64)
+                  for c in function[1]}
+        groups.append([function, idx, params, True])
+    return groups
+
+def updateCosts(flow, groups, cost):
     '''
-    Returns the smallest node in N but not in S.
+    Updates the cost array in place, evaluating each cost function once for all its edges.
+    Functions that could not be compiled are interpreted by py_expression_eval. Functions that
+    fail on arrays (e.g., sqrt raises TypeError, and min, max and if raise ValueError when
+    testing the truth of an array) are interpreted edge by edge from then on.
     '''
-    minNode = None
-    for node in N:
-        if node.flag == 0:
-            minNode = node
-            break
-    if minNode == None:
-        return minNode
-    for node in N:
-        if node.flag == 0 and node.dist < minNode.dist:
-            minNode = node
-    return minNode
+    for group in groups:
+        function, idx, params, vectorized = group
+        compiled = function[3] if len(function) > 3 else None
+        params[function[0]] = flow[idx]
+        if vectorized:
+            try:
+                if compiled is not None:
+                    cost[idx] = compiled(flow[idx], *[params[c] for c in function[1]])
+                else:
+                    cost[idx] = function[2].evaluate(params)
+                continue
+            except (TypeError, ValueError):
+                group[3] = False
+
+        for i, e in enumerate(idx):
+            cost[e] = function[2].evaluate({c: v[i] for c, v in params.items()})
 
-def pickEdgesList(u, E):
+def buildCSR(N, E):
     '''
-    Returns the edges list of node u.
+    Builds the compressed sparse row (CSR) adjacency of the graph, over node ids and edge indices
+    (both set by run_MSA). The outgoing edges of node v are at positions adj_start[v] up to
+    adj_start[v+1]-1 of adj_end (their end nodes) and adj_edge (their indices in E).
     '''
-    uv = []
-    for edge in E:
-        if edge.start == u.name:
-            uv.append(edge)
-    return uv
+    start = np.array([e.start_id for e in E], dtype=np.int64)
+    adj_edge = np.argsort(start, kind='stable') # keep the order of E among edges of a node
+    adj_start = np.zeros(len(N) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(start, minlength=len(N)), out=adj_start[1:])
+    adj_end = np.array([e.end_id for e in E], dtype=np.int64)[adj_edge]
+    return adj_start, adj_end, adj_edge
+
+def buildBuffers(V):
+    '''
+    Returns the (dist, prev, reached, visited) buffers of dijkstra for a graph with V nodes:
+    NumPy arrays for the compiled kernel, when Numba is available, or else lists, which are
+    faster than arrays to index one element at a time from Python.
+    '''
+    if njit is not None:
+        return [np.full(V, INF), np.full(V, -1, dtype=np.int64), np.zeros(V, dtype=np.int64),
+                np.zeros(V, dtype=np.int64)]
+    return [[INF] * V, [-1] * V, [0] * V, [0] * V]
 
-def dijkstra(N, E, origin, destination, ignoredEdges):
+def dijkstra(adj, origin, destination, ignoredEdges, buffers, gen):
     '''
-    Dijkstra's shortest path algorithm.
+    Dijkstra's shortest path algorithm (binary heap with lazy deletion).
+    In:
+        adj:List = Lists (adj_start, adj_end, adj_edge, adj_cost, edge_start), i.e., the CSR
+            adjacency built by buildCSR, the cost of each of its positions and the start
+            node of each edge. With NumPy arrays (and buffers, see buildBuffers) instead of
+            lists, the compiled kernel is used when Numba is available.
+        origin:Integer = Id of the origin node.
+        destination:Integer = Id of the destination node, or None to compute the shortest
+            paths to all nodes (to be read with tracePath).
+        ignoredEdges:Iterable = Indices of the edges that must not be used.
+        buffers:List = Lists (dist, prev, reached, visited) of size |V|, reused across calls.
+            dist[v] and prev[v] are only valid if reached[v] == gen, and v is finalized if
+            visited[v] == gen.
+        gen:Integer = Generation of this call, greater than that of any previous call using
+            the same buffers, so they need no reset.
+    Out:
+        S:List = Indices of the edges of the shortest path (empty if destination is unreachable
+            or None).
     '''
+    # constant time membership tests, whatever the caller passed
+    if not isinstance(ignoredEdges, (set, frozenset)):
+        ignoredEdges = frozenset(ignoredEdges)
+
+    adj_start, adj_end, adj_edge, adj_cost, edge_start = adj
+    dist, prev, reached, visited = buffers
+
+    if njit is not None and isinstance(adj_start, np.ndarray):
+        ignored = NO_EDGES_MASK
+        if ignoredEdges:
+            ignored = np.zeros(len(edge_start), dtype=np.bool_)
+            ignored[list(ignoredEdges)] = True
+        dijkstraTree(adj_start, adj_end, adj_edge, adj_cost, ignored, origin,
+                     -1 if destination is None else destination, dist, prev, reached, visited, gen)
+        if destination is None:
+            return []
+        return tracePath(adj, origin, destination, buffers, gen)
+
+    dist[origin] = 0.0
+    reached[origin] = gen
+    # heap entries are (dist, node id): nodes at equal distance are settled in N order, as the
+    # original linear scan did, so ties choose the same shortest paths
+    heap = [(0.0, origin)]
+    while heap:
+        d, u = heapq.heappop(heap)
+        # skip stale entries of already finalized nodes
+        if visited[u] == gen:
+            continue
+        visited[u] = gen
 
-    #reset the graph (so as to discard information from previous runs)
-    resetGraph(N)
+        # stop when destination is reached
+        if u == destination:
+            break
 
-    # set origin node distance to zero, and get destination node
-    dest = None
-    for node in N:
-        if node.name == origin:
-            node.dist = 0
-        if node.name == destination:
-            dest = node
-
-    u = pickSmallestNode(N)
-    while u != None:
-        u.flag = 1
-        uv = pickEdgesList(u, E)
-        n = None
-        for edge in uv:
+        for k in range(adj_start[u], adj_start[u+1]):
             # avoid ignored edges
-            if edge in ignoredEdges:
+            if adj_edge[k] in ignoredEdges:
                 continue
 
-            # take the node n
-            for node in N:
-                if node.name == edge.end:
-                    n = node
-                    break
-            if n.dist > u.dist + edge.cost:
-                n.dist = u.dist + edge.cost
-                n.prev = u
+            v = adj_end[k]
+            alt = d + adj_cost[k]
+            if reached[v] != gen or alt < dist[v]:
+                reached[v] = gen
+                dist[v] = alt
+                prev[v] = adj_edge[k]
+                heapq.heappush(heap, (alt, v))
 
-        u = pickSmallestNode(N)
-        # stop when destination is reached
-        if u == dest:
-            break
+    if destination is None:
+        return []
+    return tracePath(adj, origin, destination, buffers, gen)
+
+def tracePath(adj, origin, destination, buffers, gen):
+    '''
+    Returns the indices of the edges of the shortest path from origin to destination, as
+    found by the dijkstra call of generation gen (empty if destination was not reached).
+    '''
+    edge_start = adj[4]
+    _, prev, reached, _ = buffers
+
+    if njit is not None and isinstance(edge_start, np.ndarray):
+        return tracePathKernel(edge_start, prev, reached, origin, destination, gen).tolist()
 
-    # generate the final path
     S = []
-    u = dest
-    while u.prev != None:
-        S.insert(0,u)
-        u = u.prev
-    S.insert(0,u)
+    if reached[destination] != gen:
+        return S
+    u = destination
+    while u != origin:
+        S.append(prev[u])
+        u = edge_start[prev[u]]
+    S.reverse()
 
     return S
 
@@ -237,52 +446,66 @@ def printGraph(N, E):
     '''
     print('vertices:')
     for node in N:
-        previous = node.prev
-        if previous == None:
-            print(node.name, node.dist, previous)
-        else:
-            print(node.name, node.dist, previous.name)
+        print(node.name)
     print('edges:')
     for edge in E:
         print(edge.start, edge.end, edge.cost)
 
-def calcPathLength(P, N, E):
+def buildEdgeLookup(E):
+    '''
+    Returns a dictionary mapping (start, end) node names to the corresponding edge
+    (the first one in E, if there are parallel edges).
+    '''
+    edge_lookup = {}
+    for edge in E:
+        edge_lookup.setdefault((edge.start, edge.end), edge)
+    return edge_lookup
+
+def calcPathLength(P, N, E, edge_lookup=None, name_to_node=None):
     '''
     Calculate path P's cost.
+    The edge_lookup (see buildEdgeLookup) and name_to_node (see getPathAsNodes) may be passed
+    to avoid rebuilding them on each call.
     '''
-    if type(P[0]) is Edge:
-        P = getPathAsNodes(P, N, E)
+    if P and type(P[0]) is Edge:
+        P = getPathAsNodes(P, N, E, name_to_node)
+    if edge_lookup is None:
+        edge_lookup = buildEdgeLookup(E)
     length = 0
     prev = None
     for node in P:
         if prev != None:
-            length += [edge for edge in E if edge.start == prev.name and edge.end == node.name][0].cost
+            length += edge_lookup[(prev.name, node.name)].cost
         prev = node
 
     return length
 
-def getPathAsEdges(P, E):
+def getPathAsEdges(P, E, edge_lookup=None):
     '''
     Get the edges in the path.
+    The edge_lookup (see buildEdgeLookup) may be passed to avoid rebuilding it on each call.
     '''
+    if edge_lookup is None:
+        edge_lookup = buildEdgeLookup(E)
     path = []
     prev = None
     for node in P:
         if prev != None:
-            path.append([edge for edge in E if edge.start == prev.name and edge.end == node.name][0])
+            path.append(edge_lookup[(prev.name, node.name)])
         prev = node
 
     return path
 
-def getPathAsNodes(P, N, E):
+def getPathAsNodes(P, N, E, name_to_node=None):
     '''
     Get the nodes in a path.
+    The name_to_node dictionary ({node.name: node}) may be passed to avoid rebuilding it on each call.
     '''
-    path = []
-    path.append(node for node in N if P[0].start == N.node)
-    for edge in P:
-        path.append(node for node in N if edge.end == N.node)
-    return path
+    if not P:
+        return []
+    if name_to_node is None:
+        name_to_node = {node.name: node for node in N}
+    return [name_to_node[P[0].start]] + [name_to_node[edge.end] for edge in P]
 
 def printPath(path, N, E):
     '''
@@ -299,9 +522,9 @@ def printPath(path, N, E):
 
     print("%g = %s" % (calcPathLength(path, N, E), strout))
 
-def pathToStr(path, N, E):
-    if type(path[0]) is Node:
-        path = getPathAsEdges(path, E)
+def pathToStr(path, N, E, edge_lookup=None):
+    if path and type(path[0]) is Node:
+        path = getPathAsEdges(path, E, edge_lookup)
 
     strout = ""
     for e in path:
@@ -328,11 +551,41 @@ def run_MSA(its, N, E, OD_matrix, net_file_basename, output):
     '''
     A nested dictionary data structure to store, for each OD pair,
     its routes, and, for each route, its edges and flows
-    an entry can be said a 4-uple: (OD, route string, route, flow).
+    an entry can be said a 4-uple: (OD, route key, route, flow), where
+    the route key is the tuple of the indices of its edges.
     '''
 
     od_routes_flow = {od : {} for od in OD_matrix}
 
+    # nodes are referred to by integer ids while iterating
+    node_id = {node.name: i for i, node in enumerate(N)}
+
+    # flows and costs of the edges are kept in arrays (indexed by edge.idx) while iterating
+    for i, e in enumerate(E):
+        e.idx = i
+        e.start_id = node_id[e.start]
+        e.end_id = node_id[e.end]
+    flow = np.array([e.flow for e in E], dtype=np.float64)
+    cost = np.array([e.cost for e in E], dtype=np.float64)
+    groups = buildCostGroups(E)
+
+    # the topology does not change, only the costs of the CSR positions are updated
+    adj_start, adj_end, adj_edge = buildCSR(N, E)
+    adj = [adj_start, adj_end, adj_edge, None, np.array([e.start_id for e in E], dtype=np.int64)]
+    if njit is None:
+        # without the compiled kernel, lists are faster to traverse
+        adj = [a if a is None else a.tolist() for a in adj]
+
+    # OD pairs grouped by origin
+    by_origin = defaultdict(list)
+    for od in OD_matrix:
+        [o, d] = od.split("|")
+        by_origin[node_id[o]].append((od, node_id[d]))
+
+    # shortest path buffers, shared by all dijkstra calls (each one with a new generation)
+    buffers = buildBuffers(len(N))
+    gen = 0
+
     # iterations
     for n in range(1, its+1):
 
@@ -340,50 +593,74 @@ def run_MSA(its, N, E, OD_matrix, net_file_basename, output):
         phi = 1.0 / n
 
         # clear auxiliary flow of all links
-        for e in E:
-            e.aux_flow = 0
-            #e.flow = 0
+        aux_flow = np.zeros(len(E))
+
+        # costs of the current iteration
+        adj[3] = cost[adj_edge] if njit is not None else cost[adj_edge].tolist()
 
         # calculate auxiliary flow based on a all-or-nothing assignment
         min_routes = {}
-        for od in OD_matrix:
-            [o, d] = od.split("|")
-
-
-            # compute shortest route
-            route = getPathAsEdges(dijkstra(N, E, o, d, []), E)
-            route_str = pathToStr(route, N, E)
-
-            # store min route of this od pair
-            min_routes[od] = [route_str, route]
-
-            # if the min route is not in the od routes' list, add it
-            if route_str not in od_routes_flow[od]:
-                od_routes_flow[od][route_str] = [route, 0]
+        for o, destinations in by_origin.items():
+            # a single shortest path tree serves all OD pairs of this origin
+            gen += 1
+            if len(destinations) == 1:
+                # dijkstra stops at the destination and already traces its path
+                paths = [dijkstra(adj, o, destinations[0][1], NO_EDGES, buffers, gen)]
+            else:
+                dijkstra(adj, o, None, NO_EDGES, buffers, gen)
+                paths = [tracePath(adj, o, d, buffers, gen) for _, d in destinations]
+
+            for (od, _), path in zip(destinations, paths):
+                # compute shortest route
+                route_key = tuple(path)
+
+                # store min route of this od pair
+                min_routes[od] = route_key
+
+                # if the min route is not in the od routes' list, add it
+                if route_key not in od_routes_flow[od]:
+                    route = [E[i] for i in route_key]
+                    route_idx = np.fromiter(route_key, dtype=np.int64, count=len(route_key))
+                    od_routes_flow[od][route_key] = [route, 0, route_idx]
 
         # calculate current flow of all links
         for od in OD_matrix:
+            threshold = PRUNE_EPSILON * OD_matrix[od]
+            vanished = None
             for route in od_routes_flow[od]:
                 # route flow on previous iteration
                 vna = od_routes_flow[od][route][1]
 
                 # auxiliary route flow (0 if not the current best route)
                 fa = 0
-                if route == min_routes[od][0]:
+                if route == min_routes[od]:
                     fa = OD_matrix[od]
 
                 # route flow of current iteration
                 vna = max((1 - phi) * vna + phi * fa, 0)
 
+                # routes whose flow has vanished are dropped after the loop
+                if vna < threshold and route != min_routes[od]:
+                    if vanished is None:
+                        vanished = []
+                    vanished.append(route)
+                    continue
+
                 # update flows and costs
                 od_routes_flow[od][route][1] = vna
-                for e in od_routes_flow[od][route][0]:
-                    e.aux_flow += vna
-                    #e.flow += vna
+                scatterRouteFlow(od_routes_flow[od][route][2], vna, aux_flow)
+
+            if vanished is not None:
+                for route in vanished:
+                    del od_routes_flow[od][route]
 
-        for e in E:
-            e.flow = e.aux_flow
-            e.update_cost()
+        flow = aux_flow
+        updateCosts(flow, groups, cost)
+
+    # copy the final assignment back to the edges
+    for e, f, c in zip(E, flow.tolist(), cost.tolist()):
+        e.flow = e.aux_flow = e.params[e.var] = f
+        e.cost = c
 
     # print the final assignment
     UE = evaluate_assignment(OD_matrix, od_routes_flow, net_file_basename, its, E, output=output)
@@ -407,74 +684,77 @@ def evaluate_assignment(OD_matrix, od_routes_flow, net_file_basename, its, edge_
         #The defined results folder.
         path = './results/'
         #The filename is the network name + the time of the day it was run.
-        fn = net_file_basename + '_' + str(localtime()[3]) + 'h' + str(localtime()[4]) + 'm' \
-           + str(localtime()[5]) + 's'
+        t = localtime()
+        fn = f"{net_file_basename}_{t.tm_hour}h{t.tm_min}m{t.tm_sec}s"
+
+        #Creates the folder, if needed.
+        os.makedirs(path, exist_ok=True)
 
-        #Verifies the existence of the folder.
-        if os.path.isdir(path) is False:
-            os.makedirs(path)
+        fh = open(path+fn, 'w', buffering=1<<20)
 
-        fh = open(path+fn, 'w')
+    #The results are buffered and written at once
+    lines = []
+    if output:
         #Header
-        #print('#net_name: ' + net_file_basename + ' iterations: ' + str(its), file=fh)
-        fh.write('#net_name: ' + net_file_basename + ' iterations: ' + str(its) + '\n')
-        #print("#od\troute\tflow\ttravel time\tdeviations", file=fh)
-        fh.write("#od\troute\tflow\ttravel time\tdeviations\n")
+        lines.append(f'#net_name: {net_file_basename} iterations: {its}\n')
+        lines.append("#od\troute\tflow\ttravel time\tdeviations\n")
 
     sum_tt = 0.0
     sum_deviations = 0
     delta_top = 0.0
     delta_bottom = 0.0
 
+    edge_cost = np.array([e.cost for e in edge_list], dtype=np.float64)
+
     for od in od_routes_flow:
-        aux = []
         min_cost = float('inf')
+        #Routes of current OD pair, as (route, flow, cost), for the "deviations from best"
+        #measure, which needs the minimum cost
+        routes = []
         #Calculate some information of each route
-        for route in od_routes_flow[od]:
+        for route in od_routes_flow[od].values():
+            flow = route[1]
             #Calculate cost of the route
-            cost = 0.0
-            for e in od_routes_flow[od][route][0]:
-                cost += e.cost
-                sum_tt += e.cost * od_routes_flow[od][route][1]
+            cost = float(edge_cost[route[2]].sum())
+            sum_tt += cost * flow
             #To handle imprecise double representation
             cost = round(cost * 100) / 100
             #Store minimum route cost of current OD pair
             if cost < min_cost:
                 min_cost = cost
+            routes.append((route[0], flow, cost))
 
-            #Store the values in a temporary data structure to allow
-            #The calculations of the "deviations from best" measure
-            aux.append([od, route, od_routes_flow[od][route][1], cost])
-        #Read the temporary data structure and print the results
-        for e in aux:
+        for route, flow, cost in routes:
             #Calculate the "deviations from best" measure
-            deviations = 0
-            if e[3] > min_cost:
-                deviations = e[2]
+            deviations = 0.0
+            if cost > min_cost:
+                deviations = flow
                 sum_deviations += deviations
             #Update the top part of delta equation
-            delta_top += e[2] * (e[3] - min_cost)
+            delta_top += flow * (cost - min_cost)
             if output:
-                fh.write("{}\t{:^60}\t{:^6.2f}\t{:^5.2f}\t{:.2f}\n".format(e[0], e[1], e[2], e[3], float(deviations)))
+                lines.append(f"{od}\t{pathToStr(route, None, edge_list):^60}\t{flow:^6.2f}\t{cost:^5.2f}\t{deviations:.2f}\n")
 
-		#Update the bottom part of delta equation
+        #Update the bottom part of delta equation
         delta_bottom += OD_matrix[od]# * min_cost
     #Overall results
-    UE = (sum_tt / sum([x for x in OD_matrix.values()]))
+    UE = sum_tt / sum(OD_matrix.values())
     if output:
-        fh.write("Average travel time: {} min\n".format(UE))
-        fh.write("Deviations: {}\n".format(int(sum_deviations)))
-        fh.write("AEC: {:.10f}\n".format(delta_top / delta_bottom))
+        lines.append(f"Average travel time: {UE} min\n")
+        lines.append(f"Deviations: {int(sum_deviations)}\n")
+        lines.append(f"AEC: {delta_top / delta_bottom:.10f}\n")
 
-    fh.write("Name\t" + "Time\t" + "Flow\n")
-    for edge in edge_list:
-        fh.write("{:^5}\t{:.4f}\t{:.1f}\n".format(edge.name, edge.cost, edge.flow))
+        lines.append("Name\t" + "Time\t" + "Flow\n")
+        for edge in edge_list:
+            lines.append(f"{edge.name:^5}\t{edge.cost:.4f}\t{edge.flow:.1f}\n")
 
-    fh.close()
+        fh.write(''.join(lines))
+        fh.close()
 
     return UE
 
-def run(iterations, net_file='', node_list=None, edge_list=None, od_matrix=None, output=True):
+def run(iterations, net_file='', node_list=None, edge_list=None, od_matrix=None, output=True,
+        verbose=True):
     """
     Precisely the function of running the program.
     Either pass a network file xor (node_list and edge_list and od_matrix).
@@ -484,7 +764,8 @@ def run(iterations, net_file='', node_list=None, edge_list=None, od_matrix=None,
         node_list:List = List of Node objects.
         edge_list:List = List of Edge objects.
         od_matrix:Dictionary = OD pairs and demands.
-        output:Boolean = If the results are to be printed.
+        output:Boolean = If the results are to be written to the results folder.
+        verbose:Boolean = If the final edge times and flows are to be printed.
     Out:
         node_list:List = List of Node objects.
         edge_list:List = List of Edge objects.
@@ -499,9 +780,10 @@ def run(iterations, net_file='', node_list=None, edge_list=None, od_matrix=None,
         UE, od_routes_flow = run_MSA(iterations, node_list, edge_list, od_matrix,
                      os.path.basename(net_file).split('.')[0], output)
 
-    print("Name\t" + "Time\t", "Flow")
-    for edge in edge_list:
-        print("{}\t{:.4f}\t{:.1f}".format(edge.name, edge.cost, edge.flow))
+    if verbose:
+        print("Name\t" + "Time\t", "Flow")
+        for edge in edge_list:
+            print("{}\t{:.4f}\t{:.1f}".format(edge.name, edge.cost, edge.flow))
 
     return node_list, edge_list, od_matrix, UE, od_routes_flow
 